@@ -3,101 +3,478 @@ Quickly subset Redcap inventories.
 """
 
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import os
 import pandas as pd
 import sys
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+try:
+    from numba import njit
+    # Compiled kernels are cached on disk, so only the first run pays for JIT
+    _jit = njit(cache=True)
+except ImportError:
+    def _jit(function):
+        return function
 # import sibispy
 
+# Number of inventory rows to read and filter at a time
+CHUNKSIZE = 100_000
+
+# Narrow types for the inventory columns filters look at. Flags and counts
+# may be blank, so they're nullable integers; the string columns repeat a
+# small set of values.
+INVENTORY_DTYPES = {
+    'non_nan_count': 'Int32',
+    'missing': 'Int8',
+    'complete': 'Int8',
+    'exclude': 'Int8',
+    'form_name': 'category',
+    'dag': 'category',
+    'status': 'category',
+}
+INTEGER_DTYPES = {column: dtype for column, dtype in INVENTORY_DTYPES.items()
+                  if dtype.startswith('Int')}
+
+# Bytes of CSV the pyarrow reader parses per chunk
+PYARROW_BLOCK_SIZE = 16 << 20
+
 # Reports
+#
+# Each report takes an inventory (and an optional dict of precomputed,
+# file-wide values) and returns a boolean np.ndarray marking the rows that
+# should be reported. The predicates work on the underlying NumPy
+# arrays rather than on pd.Series to skip index alignment on every operation.
+# Decorate new reports with @register_filter to make them available, and with
+# @requires to declare the columns they use.
+
+FILTERS = {}
+
+
+def register_filter(filter_function):
+    # Make filter_function available by its name (in FILTERS and on the CLI)
+    FILTERS[filter_function.__name__] = filter_function
+    return filter_function
+
+
+def requires(*columns):
+    # Declare the inventory columns a report needs, so it can be skipped up
+    # front for inventories that don't have them
+    def decorator(filter_function):
+        filter_function._REQUIRED_COLS = columns
+        return filter_function
+    return decorator
+
+
+def _values(inventory, column, ctx=None):
+    # Raises KeyError if the inventory doesn't have the column. Numeric
+    # columns are converted to float32 with blanks as NaN, which is what the
+    # kernels below take. With a cache in ctx['values'] (per chunk, see
+    # iter_filter_results), each column is only converted once for all the
+    # reports applied to the chunk.
+    cache = ctx.get('values') if ctx is not None else None
+    if cache is not None and column in cache:
+        return cache[column]
+    series = inventory[column]
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        values = series.to_numpy(dtype='float32', na_value=np.nan)
+    else:
+        values = series.to_numpy()
+    if cache is not None:
+        cache[column] = values
+    return values
+
+
+# Kernels
+#
+# The numeric part of each report, as an array expression over the float32
+# columns (plus a boolean mask for conditions on form_name, which is done in
+# NumPy). With numba installed, each expression is compiled into a single
+# fused pass over the columns; without it, they're plain NumPy.
+
+@_jit
+def _empty_marked_present(nnc, miss, excl, keep):
+    return (nnc == 0) & (miss == 0) & (excl != 1) & keep
+
+
+@_jit
+def _content_marked_missing(nnc, miss, excl):
+    return (miss == 1) & (nnc > 0) & (excl != 1)
+
+
+@_jit
+def _less_content_than_max(nnc, max_non_nan, keep):
+    return (nnc > 0) & (nnc < max_non_nan) & keep
+
+
+@_jit
+def _empty_unmarked(nnc, miss, excl):
+    return (nnc == 0) & np.isnan(miss) & (excl != 1)
+
+
+@_jit
+def _content_unmarked(nnc, miss):
+    return (nnc > 0) & np.isnan(miss)
+
+
+@_jit
+def _content_not_complete(nnc, comp, keep):
+    return (nnc > 0) & (comp < 2) & keep
+
+
+@_jit
+def _missing_not_complete(miss, comp):
+    return (miss == 1) & (comp < 2)
+
+
+@_jit
+def _excluded_with_content(nnc, excl, keep):
+    return (excl == 1) & (nnc > 0) & keep
+
 
 ## 1. Reports that indicate mistakes (site check required)
 
 # empty_marked_present
-def empty_marked_present(inventory):
+@register_filter
+@requires('non_nan_count', 'missing', 'exclude', 'form_name')
+def empty_marked_present(inventory, ctx=None):
     # -> Site should investigate why the form was marked "not missing"
-    return ((inventory['non_nan_count'] == 0)
-            & (inventory['missing'] == 0)
-            & (inventory['exclude'] != 1)
-            & (inventory['form_name'] != 'biological_mr'))  # false positives
+    return _empty_marked_present(
+        _values(inventory, 'non_nan_count', ctx),
+        _values(inventory, 'missing', ctx),
+        _values(inventory, 'exclude', ctx),
+        # (biological_mr hits are false positives)
+        _values(inventory, 'form_name', ctx) != 'biological_mr')
 
 
 # content_marked_missing
-def content_marked_missing(inventory):
+@register_filter
+@requires('non_nan_count', 'missing', 'exclude')
+def content_marked_missing(inventory, ctx=None):
     # -> Missingness likely applied by mistake, should be switched to present
-    return ((inventory['missing'] == 1) 
-            & (inventory['non_nan_count'] > 0)
-            & (inventory['exclude'] != 1))
+    return _content_marked_missing(_values(inventory, 'non_nan_count', ctx),
+                                   _values(inventory, 'missing', ctx),
+                                   _values(inventory, 'exclude', ctx))
 
 ## 2. Reports that contain possible omissions (site check recommended)
 
-def less_content_than_max(inventory):
+@register_filter
+@requires('non_nan_count', 'form_name')
+def less_content_than_max(inventory, ctx=None):
     # -> Site should ensure that no content was omitted
     # (only makes sense on some forms)
-    return ((inventory['non_nan_count'] > 0) &
-            (inventory['non_nan_count'] < inventory['non_nan_count'].max()) &
-            (~inventory['form_name'].isin(['limesurvey_ssaga_youth','limesurvey_ssaga_parent','youth_report_2','youth_report_1b','mri_report','youth_report_1','parent_report','participant_last_use_summary']))
-    )
+    # (when inventory is only a chunk of the file, ctx['max_non_nan'] must be
+    #  precomputed over the whole file)
+    nnc = _values(inventory, 'non_nan_count', ctx)
+    form = _values(inventory, 'form_name', ctx)
+    if ctx is not None and 'max_non_nan' in ctx:
+        max_non_nan = ctx['max_non_nan']
+    else:
+        max_non_nan = np.nanmax(nnc)
+    return _less_content_than_max(
+        nnc, float(max_non_nan),
+        ~np.isin(form, ['limesurvey_ssaga_youth','limesurvey_ssaga_parent','youth_report_2','youth_report_1b','mri_report','youth_report_1','parent_report','participant_last_use_summary']))
 
-def empty_unmarked(inventory):
+@register_filter
+@requires('non_nan_count', 'missing', 'exclude')
+def empty_unmarked(inventory, ctx=None):
     # -> Site should double-check that these cases are actually absent, and
     #    mark missingness where appropriate
     # (potentially better handled in check_form_groups)
     # (hits "grey" circles, but not just them)
-    return ((inventory['non_nan_count'] == 0)
-            & inventory['missing'].isnull()
-            & (inventory['exclude'] != 1))
+    return _empty_unmarked(_values(inventory, 'non_nan_count', ctx),
+                           _values(inventory, 'missing', ctx),
+                           _values(inventory, 'exclude', ctx))
 
 
 ## 3. Reports that indicate undermarking, and can be auto-marked (site consent requested)
 ### 3a. Undermarking of non-missingness
 
-def content_unmarked(inventory):
+@register_filter
+@requires('non_nan_count', 'missing')
+def content_unmarked(inventory, ctx=None):
     # -> Site should confirm that hits can be automatically marked "not missing"
-    return (inventory['non_nan_count'] > 0) & (inventory['missing'].isnull())
+    return _content_unmarked(_values(inventory, 'non_nan_count', ctx),
+                             _values(inventory, 'missing', ctx))
 
 
 ### 3b. Undermarking of completion
-def content_not_complete(inventory):
+@register_filter
+@requires('non_nan_count', 'complete', 'form_name')
+def content_not_complete(inventory, ctx=None):
     # -> Site should confirm that hits can be automatically marked "complete"
-    return ((inventory['non_nan_count'] > 0)
-            & (inventory['complete'] < 2)
-            # Computed forms that will be marked Complete once other forms are
-            & (~inventory['form_name'].isin(['clinical', 'brief']))
-            )
+    return _content_not_complete(
+        _values(inventory, 'non_nan_count', ctx),
+        _values(inventory, 'complete', ctx),
+        # Computed forms that will be marked Complete once other forms are
+        ~np.isin(_values(inventory, 'form_name', ctx),
+                 ['clinical', 'brief']))
 
 
-def missing_not_complete(inventory):
+@register_filter
+@requires('missing', 'complete')
+def missing_not_complete(inventory, ctx=None):
     # -> Site should confirm that hits can be automatically marked "complete"
-    return (inventory['missing'] == 1) & (inventory['complete'] < 2)
+    return _missing_not_complete(_values(inventory, 'missing', ctx),
+                                 _values(inventory, 'complete', ctx))
 
 
 ### 4. Excluded forms with content on them
-def excluded_with_content(inventory):
+@register_filter
+@requires('non_nan_count', 'exclude', 'form_name')
+def excluded_with_content(inventory, ctx=None):
     # -> Site should either unmark exclusion, or have the content deleted
-    return ((inventory['exclude'] == 1)
-            & (inventory['non_nan_count'] > 0)
-            & (~inventory['form_name'].isin(['visit_date', 'clinical'])))
+    return _excluded_with_content(
+        _values(inventory, 'non_nan_count', ctx),
+        _values(inventory, 'exclude', ctx),
+        ~np.isin(_values(inventory, 'form_name', ctx),
+                 ['visit_date', 'clinical']))
 
 # Reports -- end
 
+FILTER_NAMES = tuple(FILTERS)
 
-def get_filter_results(inventorized_data, filter_function, verbose=False):
+
+def get_missing_columns(filter_function, columns):
     """
-    Apply pd.Index-returning function to data and return it filtered.
+    Return the columns filter_function requires that aren't in columns.
+
+    Filters not decorated with @requires don't declare any.
     """
-    try:
-        index = filter_function(inventorized_data)
-    except KeyError as e:
+    return [column
+            for column in getattr(filter_function, '_REQUIRED_COLS', ())
+            if column not in columns]
+
+
+def get_filter_results(inventorized_data, filter_function, verbose=False,
+                       ctx=None):
+    """
+    Apply boolean mask-returning function to data and return it filtered.
+
+    Returns None without applying the function if data lacks any of the
+    columns the function requires.
+    """
+    missing_columns = get_missing_columns(filter_function,
+                                          inventorized_data.columns)
+    if missing_columns:
         if verbose:
-            print("Error in {}:".format(filter_function.__name__), str(e))
+            print("Error in {}: missing columns {}"
+                  .format(filter_function.__name__, missing_columns))
+        return None
+    mask = filter_function(inventorized_data, ctx)
+    return inventorized_data.iloc[mask]
+
+
+def read_inventory(filename, chunksize=CHUNKSIZE):
+    """
+    Return an iterator over chunks of the inventory file.
+
+    Uses pyarrow's streaming CSV reader if pyarrow is installed (in which case
+    chunks are sized by PYARROW_BLOCK_SIZE rather than chunksize).
+    """
+    if pa is not None:
+        return _read_inventory_pyarrow(filename)
+    # As in _read_inventory_pyarrow, columns without a fixed type stay
+    # strings, so they're written back out as they were read (a blank would
+    # otherwise turn e.g. arm into a float column, written as "1.0")
+    dtypes = {column: INVENTORY_DTYPES.get(column, str)
+              for column in read_inventory_columns(filename)}
+    return pd.read_csv(filename, chunksize=chunksize, dtype=dtypes)
+
+
+def read_inventory_columns(filename):
+    """
+    Return the column names of the inventory file, without reading any rows.
+    """
+    return pd.read_csv(filename, nrows=0).columns
+
+
+def union_columns(column_lists):
+    """
+    Return the union of column_lists, in order of first appearance (like
+    pd.concat(sort=False) does).
+    """
+    return pd.Index(list(dict.fromkeys(column
+                                       for columns in column_lists
+                                       for column in columns)))
+
+
+def _read_inventory_pyarrow(filename, block_size=PYARROW_BLOCK_SIZE):
+    # Column names come from pandas, so they're the same as pd.read_csv's
+    # (e.g. "Unnamed: 0" for the blank index header)
+    columns = read_inventory_columns(filename)
+    # Every column type is fixed up front: the streaming reader would
+    # otherwise infer types from the first block alone (a column that's
+    # blank there is typed null and fails on later blocks) and parse
+    # timestamps, which changes how they're written back out. Counts and
+    # flags may be written as floats ("0.0"), so they're read as such and
+    # converted below, as pd.read_csv does; everything else stays a string.
+    column_types = {column: pa.float64()
+                    if column in INTEGER_DTYPES else pa.string()
+                    for column in columns}
+    reader = pa_csv.open_csv(
+        filename,
+        read_options=pa_csv.ReadOptions(block_size=block_size,
+                                        column_names=list(columns),
+                                        skip_rows=1),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                              strings_can_be_null=True))
+    dtypes = {column: dtype for column, dtype in INVENTORY_DTYPES.items()
+              if column in columns}
+    for batch in reader:
+        yield batch.to_pandas().astype(dtypes)
+
+
+def get_max_non_nan(filename, chunksize=CHUNKSIZE):
+    """
+    Return the maximum non_nan_count across all chunks of the inventory file.
+
+    Only the non_nan_count column is parsed; raises KeyError if it's absent.
+    """
+    try:
+        reader = pd.read_csv(filename, usecols=['non_nan_count'],
+                             chunksize=chunksize)
+        chunk_maxes = np.fromiter((chunk['non_nan_count'].max()
+                                   for chunk in reader), dtype=float)
+    except ValueError as e:
+        # pandas reports usecols that aren't in the file as ValueError
+        raise KeyError(str(e))
+    if chunk_maxes.size == 0 or np.isnan(chunk_maxes).all():
         return None
+    return np.nanmax(chunk_maxes)
+
+
+def iter_filter_results(filename, filter_functions, verbose=False):
+    """
+    Apply each of filter_functions to every chunk of the inventory file,
+    reading the file only once.
+
+    Yields (filter name, non-empty filtered chunk) pairs as the file is read,
+    or (filter name, None) once if the filter can't be applied to the file.
+    """
+    failed = set()
+
+    ctx = {}
+    if less_content_than_max in filter_functions:
+        # The maximum has to be taken over the whole file, not per chunk
+        try:
+            ctx['max_non_nan'] = get_max_non_nan(filename)
+        except KeyError as e:
+            if verbose:
+                print("Error in {}:".format(less_content_than_max.__name__),
+                      str(e))
+            ctx['max_non_nan'] = None
+        if ctx['max_non_nan'] is None:
+            failed.add(less_content_than_max.__name__)
+            yield less_content_than_max.__name__, None
+
+    for chunk in read_inventory(filename):
+        # Columns converted for one filter are reused by the others
+        chunk_ctx = dict(ctx, values={})
+        for filter_function in filter_functions:
+            if filter_function.__name__ in failed:
+                continue
+            result = get_filter_results(chunk, filter_function,
+                                        verbose=verbose, ctx=chunk_ctx)
+            if result is None:
+                failed.add(filter_function.__name__)
+                yield filter_function.__name__, None
+            elif not result.empty:
+                yield filter_function.__name__, result
+
+
+def filter_inventory_file(filename, filter_functions, verbose=False):
+    """
+    Return all of iter_filter_results for the file as a list, e.g. to send
+    them back from a worker process.
+    """
+    return list(iter_filter_results(filename, filter_functions,
+                                    verbose=verbose))
+
+
+def get_filter_output(output, filter_name):
+    """
+    Return where to write results of filter_name when output is one per
+    filter: output with {filter} replaced by the name if it has that
+    placeholder, otherwise <filter_name>.csv in the output directory.
+    """
+    if '{filter}' in output:
+        # (not str.format, so other braces in the path are left alone)
+        return output.replace('{filter}', filter_name)
+    return os.path.join(output, '{}.csv'.format(filter_name))
+
+
+def map_inventory_files(function, filenames, jobs=1):
+    """
+    Yield function(filename) for each file, in order.
+
+    With jobs > 1, files are processed in a pool of worker processes. Only
+    jobs files are submitted at a time (executor.map would submit them all
+    at once), so at most that many files' results are held in memory while
+    the caller writes out earlier ones.
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = deque()
+            for filename in filenames:
+                if len(pending) == jobs:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(function, filename))
+            while pending:
+                yield pending.popleft().result()
     else:
-        return inventorized_data.loc[index]
+        yield from map(function, filenames)
+
+
+class FilterResultWriter(object):
+    """
+    Stream filter results into a single CSV output, one frame at a time.
+
+    The output is only opened once there's something to write, and it's
+    opened once for the whole run. Every frame is written with the given
+    columns (by default, those of the first frame written), so columns should
+    be known up front, e.g. as the union_columns of all inputs.
+    """
+
+    def __init__(self, output, columns=None):
+        self.output = output
+        self.columns = columns
+        self._fh = None
+
+    def write(self, result):
+        header = self._fh is None
+        if header:
+            if self.columns is None:
+                self.columns = result.columns
+            if isinstance(self.output, str):
+                self._fh = open(self.output, 'w', newline='')
+            else:
+                self._fh = self.output
+        if not result.columns.equals(self.columns):
+            result = result.reindex(columns=self.columns)
+        # Counts and flags are written as integers by the C writer, rather
+        # than as floats through a per-cell float_format
+        result = result.astype({column: dtype
+                                for column, dtype in INTEGER_DTYPES.items()
+                                if column in result})
+        result.to_csv(self._fh, index=False, header=header)
+
+    def close(self):
+        if self._fh is not None and self._fh is not self.output:
+            self._fh.close()
 
 
 def parse_args(filter_choices, input_args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="Verbose operation",
                         action="store_true")
+    # NOTE: if this is ever enabled, files must be filtered serially (-j 1)
     # parser.add_argument("-p", "--post-to-github",
     #                     help="Post all issues to GitHub instead of stdout.",
     #                     action="store_true")
@@ -106,61 +483,104 @@ def parse_args(filter_choices, input_args=None):
                         nargs='+',
                         required=True)
     parser.add_argument('-o', '--output',
-                        help="File to save filtered inventory to",
+                        help="File to save filtered inventory to, a "
+                        "directory to save <FILTER>.csv files to, or a path "
+                        "containing {filter} (required with multiple "
+                        "filters to be one of the latter two)",
                         default=sys.stdout)
+    parser.add_argument('-j', '--jobs',
+                        help="Number of input files to filter in parallel "
+                        "(default: one per input file, up to CPU count)",
+                        type=int)
     # `choices` in `help` courtesy of https://stackoverflow.com/a/20335589
     parser.add_argument('filter', metavar='FILTER', choices=filter_choices,
-                        help="Filter function to apply, one of following: "
+                        nargs='+',
+                        help="Filter function(s) to apply, from following: "
                         "{%(choices)s}")
     args = parser.parse_args(input_args)
+    if len(args.filter) > 1 and args.output == sys.stdout:
+        parser.error("--output is required when applying multiple filters")
     return args
 
 
 if __name__ == '__main__':
-    # TODO: There should be some way to auto-generate this - maybe embed the
-    # filters in a file, import it, then get the names of all callables?
-    FILTER_LIST = [
-        empty_marked_present,
-        content_marked_missing,
-        less_content_than_max,
-        empty_unmarked,
-        content_unmarked,
-        content_not_complete,
-        missing_not_complete,
-        excluded_with_content,
-    ]
-    FILTERS = {x.__name__: x for x in FILTER_LIST}
-
-    args = parse_args(FILTERS.keys())
-
-    # TODO: Should explicitly assume + read in columns?
-    all_out = []
-    for filename in args.input:
-        data = pd.read_csv(filename)
-        filter_function = FILTERS[args.filter]
-        result = get_filter_results(data, filter_function,
-                                    verbose=args.verbose)
-        if result is None:
-            if args.verbose:
-                print("Filter {} failed on file {}; skipping"
-                      .format(args.filter, filename))
-        elif not result.empty:
-            all_out.append(result)
+    args = parse_args(FILTER_NAMES)
 
-            if args.verbose:
-                if args.output == sys.stdout:
+    # Filters in the order given, without repeats
+    filter_names = list(dict.fromkeys(args.filter))
+    # With a single filter, --output can also be a plain file (or stdout)
+    output_per_filter = len(filter_names) > 1 or (
+        isinstance(args.output, str)
+        and ('{filter}' in args.output or os.path.isdir(args.output)))
+    if output_per_filter:
+        outputs = {name: get_filter_output(args.output, name)
+                   for name in filter_names}
+    else:
+        outputs = {filter_names[0]: args.output}
+    # Outputs are only opened once there's something to write to them, so
+    # check that their directories exist before any input is read
+    for output in outputs.values():
+        if output != sys.stdout:
+            output_dir = os.path.dirname(output)
+            if output_dir and not os.path.isdir(output_dir):
+                sys.exit("Output directory {} does not exist"
+                         .format(output_dir))
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = min(len(args.input), os.cpu_count() or 1)
+
+    # Results are streamed out, so the columns of each output (all columns
+    # of the inputs the filter applies to) have to be known before the first
+    # one is written
+    input_columns = [read_inventory_columns(filename)
+                     for filename in args.input]
+    writers = {
+        name: FilterResultWriter(output, columns=union_columns(
+            columns for columns in input_columns
+            if not get_missing_columns(FILTERS[name], columns)))
+        for name, output in outputs.items()}
+    filter_functions = [FILTERS[name] for name in filter_names]
+    if jobs > 1:
+        # Worker processes can't send back a generator, so the results of
+        # each file are collected before they're written
+        filter_file = partial(filter_inventory_file,
+                              filter_functions=filter_functions,
+                              verbose=args.verbose)
+    else:
+        # Results are written out chunk by chunk as the file is read
+        filter_file = partial(iter_filter_results,
+                              filter_functions=filter_functions,
+                              verbose=args.verbose)
+    all_results = map_inventory_files(filter_file, args.input, jobs=jobs)
+    for filename, file_results in zip(args.input, all_results):
+        written = set()
+        failed = set()
+        for filter_name, result in file_results:
+            if result is None:
+                failed.add(filter_name)
+            else:
+                writers[filter_name].write(result)
+                written.add(filter_name)
+
+        if not args.verbose:
+            continue
+        for filter_name in filter_names:
+            if filter_name in failed:
+                print("Filter {} failed on file {}; skipping"
+                      .format(filter_name, filename))
+            elif filter_name in written:
+                if outputs[filter_name] == sys.stdout:
                     output_display_name = "stdout"
                 else:
-                    output_display_name = args.output
+                    output_display_name = outputs[filter_name]
 
                 print("Filter {} used on {} => {}"
-                      .format(args.filter, filename, output_display_name))
-        else:
-            if args.verbose:
+                      .format(filter_name, filename, output_display_name))
+            else:
                 print("Filter {} used on {} => no matches, skipping."
-                      .format(args.filter, filename))
+                      .format(filter_name, filename))
 
-    if len(all_out) > 0:
-        (pd.concat(all_out, sort=False)
-         .to_csv(args.output, index=False, float_format="%.0f"))
+    for writer in writers.values():
+        writer.close()
     sys.exit(0)
@@ -5,28 +5,31 @@ REPORT_DIR=${2:-/fs/ncanda-share/log/make_all_inventories/report/}
 INVENTORY_BY_SITE_DIR=$INVENTORY_DIR/../inventory_by_site
 REPORT_BY_SITE_DIR=$REPORT_DIR/../report_by_site
 
+FILTERS="empty_marked_present
+         content_marked_missing
+         less_content_than_max
+         empty_unmarked
+         content_unmarked
+         content_not_complete
+         missing_not_complete"
+
 SCRIPT=`realpath $0`
 SCRIPTDIR=`dirname $SCRIPT`
 
 pushd $INVENTORY_DIR
 for event_dir in *; do
-  for filter in empty_marked_present \
-                content_marked_missing \
-                less_content_than_max \
-                empty_unmarked \
-                content_unmarked \
-                content_not_complete \
-                missing_not_complete; do
-    for file in ${INVENTORY_DIR}/${event_dir}/*.csv; do
-       mkdir -p "${REPORT_DIR}/${event_dir}/${filter}";
-       new_name=$(basename "$file");
-       python $SCRIPTDIR/filter_inventory.py -i "$file" \
-         -o "${REPORT_DIR}/${event_dir}/${filter}/${new_name}" \
-         $filter
-    done; 
-    # mkdir -p ${REPORT_DIR}/${event_dir}
-    # python $SCRIPTDIR/filter_inventory.py -i ${INVENTORY_DIR}/${event_dir}/*.csv -o ${REPORT_DIR}/${event_dir}/${filter}.csv $filter
+  for filter in $FILTERS; do
+    mkdir -p "${REPORT_DIR}/${event_dir}/${filter}";
   done
+  for file in ${INVENTORY_DIR}/${event_dir}/*.csv; do
+     new_name=$(basename "$file");
+     # All filters in one run, so each file is only read once
+     python $SCRIPTDIR/filter_inventory.py -i "$file" \
+       -o "${REPORT_DIR}/${event_dir}/{filter}/${new_name}" \
+       $FILTERS
+  done; 
+  # mkdir -p ${REPORT_DIR}/${event_dir}
+  # python $SCRIPTDIR/filter_inventory.py -i ${INVENTORY_DIR}/${event_dir}/*.csv -o ${REPORT_DIR}/${event_dir}/ $FILTERS
 done
 popd
 
@@ -34,19 +37,11 @@ pushd $INVENTORY_BY_SITE_DIR
 for site in sri duke ohsu upmc ucsd; do
    pushd $INVENTORY_BY_SITE_DIR/$site
    for event_dir in *; do
-     for filter in empty_marked_present \
-                   content_marked_missing \
-                   less_content_than_max \
-                   empty_unmarked \
-                   content_unmarked \
-                   content_not_complete \
-                   missing_not_complete; do
-       mkdir -p ${REPORT_BY_SITE_DIR}/${site}/${event_dir}
-       # Create a filter file that concatenates all forms
-       python $SCRIPTDIR/filter_inventory.py -i ${event_dir}/*.csv \
-         -o ${REPORT_BY_SITE_DIR}/${site}/${event_dir}/${filter}.csv \
-         $filter
-     done
+     mkdir -p ${REPORT_BY_SITE_DIR}/${site}/${event_dir}
+     # Create a <filter>.csv file per filter that concatenates all forms
+     python $SCRIPTDIR/filter_inventory.py -i ${event_dir}/*.csv \
+       -o ${REPORT_BY_SITE_DIR}/${site}/${event_dir}/ \
+       $FILTERS
    done
    popd
 done
@@ -10,7 +10,7 @@ from builtins import str
 import os
 import re
 import tempfile
-import shutil
+from pyxnat.core.errors import DatabaseError
 from sibispy import sibislogger as slog
 from sibispy import utils as sutils
 
@@ -20,6 +20,26 @@ from sibispy import utils as sutils
 import_bindir = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), 'import', 'laptops' )
 bindir = os.path.dirname( os.path.abspath(__file__) )
 
+# File name pattern of ePrime Stroop log files
+STROOP_NAME_RE = re.compile( r'^NCANDAStroopMtS_3cycles_7m53stask_.*\.txt$' )
+
+# Get (eid, resource, file) for all ePrime Stroop files in one experiment
+def get_stroop_files( xnat, xnat_eid ):
+    try:
+        # One request for the files of all resources in the experiment
+        experiment_files = xnat._get_json( '/data/experiments/%s/files' % xnat_eid )
+    except DatabaseError:
+        # Fall back to listing files resource by resource
+        experiment = xnat.select.experiments[ xnat_eid ]
+        stroop_files = []
+        for resource in list(experiment.resources):
+            resource_files = xnat._get_json( '/data/experiments/%s/resources/%s/files' % ( xnat_eid, resource ) );
+            stroop_files += [ (xnat_eid, resource, file['URI'].rsplit( '/files/', 1 )[-1] ) for file in resource_files if STROOP_NAME_RE.match( file['Name'] ) ]
+        return stroop_files
+
+    # cat_ID is the ID of the resource the file belongs to
+    return [ (xnat_eid, file['cat_ID'], file['URI'].rsplit( '/files/', 1 )[-1] ) for file in experiment_files if STROOP_NAME_RE.match( file['Name'] ) ]
+
 # Check a list of experiments for ePrime Stroop files
 def check_for_stroop( xnat, xnat_eid_list, verbose=False ):
     stroop_files = []
@@ -27,12 +47,7 @@ def check_for_stroop( xnat, xnat_eid_list, verbose=False ):
         print("check_for_stroop: " + str(xnat_eid_list))
 
     for xnat_eid in xnat_eid_list:
-        experiment = xnat.select.experiments[ xnat_eid ]
-
-        # Get list of resource files that match the Stroop file name pattern
-        for resource in list(experiment.resources):
-            resource_files = xnat._get_json( '/data/experiments/%s/resources/%s/files' % ( xnat_eid, resource ) );
-            stroop_files += [ (xnat_eid, resource, re.sub( '.*\/files\/', '', file['URI']) ) for file in resource_files if re.match( '^NCANDAStroopMtS_3cycles_7m53stask_.*.txt$', file['Name'] ) ]
+        stroop_files += get_stroop_files( xnat, xnat_eid )
 
     # No matching files - nothing to do
     if len( stroop_files ) == 0:
@@ -57,65 +72,64 @@ def import_stroop_to_redcap( xnat, stroop_eid, stroop_resource, stroop_file, \
     if verbose:
         print("Importing Stroop data from file %s:%s" % ( stroop_eid, stroop_file ))
 
-    # Download Stroop file from XNAT into temporary directory
+    # Download Stroop file from XNAT into temporary directory, which is
+    # removed again on every return path
     experiment = xnat.select.experiments[stroop_eid]
-    tempdir = tempfile.mkdtemp()
-
-    try:
-        stroop_file_path = os.path.join( tempdir, stroop_file )
-        stroop_dir_path = os.path.dirname(stroop_file_path)
-        if not os.path.isdir(stroop_dir_path):
-            os.makedirs(stroop_dir_path)
-
-        experiment.resources[stroop_resource].files[stroop_file].download( stroop_file_path, verbose=False )
-    except IOError as e:
-        details = "Error: import_mr_sessions_stroop: unable to get copy resource {0} file {1} to {2}".format(stroop_resource, stroop_file, stroop_file_path)
-        slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), details, error_obj={ 'message': str(e), 'errno': e.errno, 'filename': e.filename, 'strerror': e.strerror })
-        return
-    # Convert downloaded Stroop file to CSV scores file
-    cmd = str(os.path.join(import_bindir, "stroop2csv")) + f' --mr-session --record "{redcap_key[0]}" --event "{redcap_key[1]}" "{str(stroop_file_path)}" "{str(tempdir)}"'
-    (ecode,sout, serr) = sutils.call_shell_program(cmd)
-    if ecode: 
-        slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run stroop2csv!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
-
-    added_files = sout
-
-    if len( added_files ):
-        if not no_upload:
-            # Upload CSV file(s) (should only be one anyway)
-            for file in added_files.decode('utf-8').split( '\n' ):
-                if re.match( '.*\.csv$', file ):
-                    if verbose:
-                        print("Uploading ePrime Stroop scores",file)
-                    cmd = str(os.path.join( bindir, 'csv2redcap' )) 
-                    if post_to_github:
-                        cmd += " -p"
-                    if time_log_dir:
-                        cmd += " -t " + str(time_log_dir)
-
-                    cmd += " " + str(file) 
-                    (ecode,sout, serr) = sutils.call_shell_program(cmd)
-                    if ecode: 
-                        slog.info(str(redcap_key[0]) + "-" + str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run csv2redcap!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
-
-            # Upload original ePrime file for future reference
-            cmd = str(os.path.join( import_bindir, "eprime2redcap" ))
-            if post_to_github: 
-                cmd += " -p" 
-
-            cmd += f' --project data_entry --record {redcap_key[0]} --event {redcap_key[1]} "{str(stroop_file_path)}" mri_stroop_log_file'
-                
-            if verbose:
-                print("Uploading ePrime Stroop file",stroop_file_path)
-                # print " ".join(cmd_array)
-
-            (ecode,sout, serr) = sutils.call_shell_program(cmd)
-            if ecode: 
-                slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run eprime2redcap!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
-
-    else:
-        error = "ERROR: could not convert Stroop file %s:%s" % ( redcap_key[0], stroop_file )
-        slog.info(str(redcap_key[0]) + '-' +  str(redcap_key[1]), error,
-                      stroop_file = stroop_file)
-
-    shutil.rmtree( tempdir )
+    with tempfile.TemporaryDirectory() as tempdir:
+        try:
+            stroop_file_path = os.path.join( tempdir, stroop_file )
+            stroop_dir_path = os.path.dirname(stroop_file_path)
+            if not os.path.isdir(stroop_dir_path):
+                os.makedirs(stroop_dir_path)
+
+            experiment.resources[stroop_resource].files[stroop_file].download( stroop_file_path, verbose=False )
+        except IOError as e:
+            details = "Error: import_mr_sessions_stroop: unable to get copy resource {0} file {1} to {2}".format(stroop_resource, stroop_file, stroop_file_path)
+            slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), details, error_obj={ 'message': str(e), 'errno': e.errno, 'filename': e.filename, 'strerror': e.strerror })
+            return
+        # Convert downloaded Stroop file to CSV scores file
+        cmd = str(os.path.join(import_bindir, "stroop2csv")) + f' --mr-session --record "{redcap_key[0]}" --event "{redcap_key[1]}" "{str(stroop_file_path)}" "{str(tempdir)}"'
+        (ecode,sout, serr) = sutils.call_shell_program(cmd)
+        if ecode: 
+            slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run stroop2csv!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
+            return
+
+        added_files = sout
+
+        if len( added_files ):
+            if not no_upload:
+                # Upload CSV file(s) (should only be one anyway)
+                for file in added_files.decode('utf-8').split( '\n' ):
+                    if file.endswith( '.csv' ):
+                        if verbose:
+                            print("Uploading ePrime Stroop scores",file)
+                        cmd = str(os.path.join( bindir, 'csv2redcap' )) 
+                        if post_to_github:
+                            cmd += " -p"
+                        if time_log_dir:
+                            cmd += " -t " + str(time_log_dir)
+
+                        cmd += " " + str(file) 
+                        (ecode,sout, serr) = sutils.call_shell_program(cmd)
+                        if ecode: 
+                            slog.info(str(redcap_key[0]) + "-" + str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run csv2redcap!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
+
+                # Upload original ePrime file for future reference
+                cmd = str(os.path.join( import_bindir, "eprime2redcap" ))
+                if post_to_github: 
+                    cmd += " -p" 
+
+                cmd += f' --project data_entry --record {redcap_key[0]} --event {redcap_key[1]} "{str(stroop_file_path)}" mri_stroop_log_file'
+                    
+                if verbose:
+                    print("Uploading ePrime Stroop file",stroop_file_path)
+                    # print " ".join(cmd_array)
+
+                (ecode,sout, serr) = sutils.call_shell_program(cmd)
+                if ecode: 
+                    slog.info(str(redcap_key[0]) + "-" +  str(redcap_key[1]), "Error: import_stroop_to_redcap: failed to run eprime2redcap!", cmd = str(cmd), stderr = str(serr), stdout = str(sout))
+
+        else:
+            error = "ERROR: could not convert Stroop file %s:%s" % ( redcap_key[0], stroop_file )
+            slog.info(str(redcap_key[0]) + '-' +  str(redcap_key[1]), error,
+                          stroop_file = stroop_file)
@@ -15,7 +15,6 @@ from typing import Sequence, List, Dict, Mapping, Union
 import yaml
 
 import github
-import pdb
 from collections import defaultdict
 import numpy as np
 
@@ -37,12 +36,8 @@ def run_batch(label, issue_numbers, metadata, force, verbose):
         print("Aborting this label...")
         return
 
-    closed_issues = []
-    commented_issues = []
+    approved_issues = []
     for scraped_issue in scraped_issues:
-        if verbose:
-            print("\n" * 20)
-            print(f"#{scraped_issue.number}")
         # List of issue types which don't need human approval to unlock/recalculate/lock
         automatic_issues = ["redcap_update_summary_scores"]
         if label not in automatic_issues and not force:
@@ -50,21 +45,51 @@ def run_batch(label, issue_numbers, metadata, force, verbose):
                 f"Unlock/recalculate/lock issue? IMPORTANT: Make sure there are not other locking issues involving the subject id you are about to recalculate before continuing. Otherwise, invalid data may propagate.\n({scraped_issue.issue.html_url})"
             ):
                 continue
-
+        approved_issues.append(scraped_issue)
+
+    # Unlock and relock all subjects of a form with one call each, so REDCap
+    # login and metadata export happen once per form rather than per subject
+    study_ids_by_form = defaultdict(list)
+    issues_by_form = defaultdict(list)
+    for scraped_issue in approved_issues:
+        issues_by_form[scraped_issue.form].append(scraped_issue)
         for command in scraped_issue.get_commands():
+            study_ids = study_ids_by_form[scraped_issue.form]
+            if command.study_id not in study_ids:
+                study_ids.append(command.study_id)
+
+    try:
+        for form, study_ids in study_ids_by_form.items():
             unlock_command = ExecRedcapLockingDataCommand(
-                verbose, command.study_id, scraped_issue.form, lock=False
-            )
-            lock_command = ExecRedcapLockingDataCommand(
-                verbose, command.study_id, scraped_issue.form, lock=True
+                verbose, study_ids, form, lock=False
             )
             print("\n")
             unlock_command.run()
-            command.run()
+
+        for scraped_issue in approved_issues:
+            if verbose:
+                print("\n" * 20)
+                print(f"#{scraped_issue.number}")
+            for command in scraped_issue.get_commands():
+                command.run()
+    finally:
+        # Forms must never be left unlocked, even if a command above failed
+        for form, study_ids in study_ids_by_form.items():
+            lock_command = ExecRedcapLockingDataCommand(
+                verbose, study_ids, form, lock=True
+            )
             lock_command.run()
             if not lock_command.ran_successfully():
-                print(f"\nErrors relocking:\n{lock_command.stringify()}")
+                for scraped_issue in issues_by_form[form]:
+                    print(
+                        f"\nErrors relocking #{scraped_issue.number} "
+                        f"({scraped_issue.issue.html_url}):\n"
+                        f"{lock_command.stringify()}"
+                    )
 
+    closed_issues = []
+    commented_issues = []
+    for scraped_issue in approved_issues:
         scraped_issue.update()
         if scraped_issue.resolved:
             closed_issues.append(f"#{scraped_issue.number}")
@@ -21,9 +21,14 @@ def prompt_y_n(prompt: str) -> bool:
         print("Invalid input")
 
 
-def get_open_issues(slog):
+def get_open_issues(slog, label: str = None):
+    """Returns the open issues, optionally only those with the passed label.
+    Label filtering is done by GitHub, so labels don't have to be fetched per
+    issue."""
     ncanda_operations = slog.log.postGithubRepo
-    issues = ncanda_operations.get_issues(state="open")
+    if label is None:
+        return ncanda_operations.get_issues(state="open")
+    issues = ncanda_operations.get_issues(state="open", labels=[label])
     return issues
 
 
@@ -32,21 +37,18 @@ def scrape_matching_issues(
 ):
     """Returns a list of issues which match the passed title, label, and issue_numbers. Issues
     are instances of the passed issue class."""
-    open_issues = get_open_issues(slog)
+    open_issues = get_open_issues(slog, target_label)
     scraped_issues = []
     for open_issue in open_issues:
         if len(issue_numbers) == 0 or open_issue.number in issue_numbers:
             if re.search(title_regex, open_issue.title):
-                for label in open_issue.get_labels():
-                    if target_label == label.name:
-                        try:
-                            scraped_issue = issue_class(verbose, open_issue, metadata)
-                        except ValueError as e:
-                            if verbose:
-                                print(e)
-                        else:
-                            scraped_issues.append(scraped_issue)
-                        break
+                try:
+                    scraped_issue = issue_class(verbose, open_issue, metadata)
+                except ValueError as e:
+                    if verbose:
+                        print(e)
+                else:
+                    scraped_issues.append(scraped_issue)
     return scraped_issues
 
 
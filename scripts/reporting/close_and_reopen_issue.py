@@ -31,11 +31,10 @@ def main():
         print("Looping through issues with site_forward in body:")
     for issue in issues:
         if 'site_forward' in issue.body:
-            waiting_on_site = False
-            for label in issue.get_labels():
-                if 'waiting-on-site' == label.name:
-                    waiting_on_site = True
-            if not waiting_on_site:
+            # issue.labels comes with the issue listing, unlike get_labels()
+            # which makes another request per issue
+            label_names = {label.name for label in issue.labels}
+            if 'waiting-on-site' not in label_names:
                 if args.verbose:
                     print(f"\n#{issue.number} missing waiting-on-site label")
                 issue.edit(state="closed")
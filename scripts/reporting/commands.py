@@ -74,33 +74,48 @@ class ExecRedcapLockingDataCommand(Command):
 
     Attributes
     ----------
-    study_id : str
-        id of subject to run command on, e.g. A-00002-F-2
+    study_id : str or list of str
+        id(s) of subject(s) to run command on, e.g. A-00002-F-2
     form : str
         Form to run command on, e.g. clinical
     lock : bool
         If true, locks the form. If false, unlocks the form.
+    base_command : tuple
+        Script and events shared by all instances.
     """
 
+    base_command = (
+        "python",
+        "/sibis-software/python-packages/sibispy/cmds/exec_redcap_locking_data.py",
+        "-e",
+        "Baseline",
+        "1y",
+        "2y",
+        "3y",
+        "4y",
+        "5y",
+        "6y",
+        "7y",
+    )
+
     def __init__(self, verbose, study_id, form, lock):
         Command.__init__(self, verbose)
         self.study_id = study_id
         self.form = form
         self.lock = lock
 
-        events = ["Baseline", "1y", "2y", "3y", "4y", "5y", "6y", "7y"]
-        script_path = (
-            "/sibis-software/python-packages/sibispy/cmds/exec_redcap_locking_data.py"
-        )
-        self.command = (
-            ["python", script_path, "-e"]
-            + events
-            + ["--forms", self.form, "--study-id", self.study_id]
-        )
-        if self.lock:
-            self.command.append("--lock")
+        if isinstance(study_id, str):
+            study_ids = [study_id]
         else:
-            self.command.append("--unlock")
+            study_ids = list(study_id)
+        self.command = [
+            *self.base_command,
+            "--forms",
+            self.form,
+            "--study-id",
+            *study_ids,
+            "--lock" if self.lock else "--unlock",
+        ]
 
 
 class RedcapUpdateSummaryScoresCommand(Command):
@@ -0,0 +1,205 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+FILTER_INVENTORY_PATH = os.path.join(os.path.dirname(__file__),
+                                     '../../../scripts/qc/filter_inventory.py')
+sys.path.append(os.path.dirname(FILTER_INVENTORY_PATH))
+import filter_inventory
+
+# An inventory as written by make_redcap_inventory: a blank index header,
+# flags written as floats, and the "missing" flag blank throughout the first
+# few rows
+INVENTORY = """\
+,study_id,redcap_event_name,arm,visit_date,dag,non_nan_count,exclude,missing,complete,form_name,status
+0,A-00001-F-1,baseline_visit_arm_1,1,2019-01-02 10:30,sri,0,0.0,,2.0,ses,EMPTY
+1,A-00002-F-1,baseline_visit_arm_1,1,2019-01-03 11:00,sri,5,0.0,,1.0,ses,PRESENT
+2,A-00003-F-1,baseline_visit_arm_1,1,,sri,0,0.0,,0.0,ses,EMPTY
+3,A-00004-F-1,baseline_visit_arm_1,1,2019-01-05 09:15,sri,3,1.0,1.0,2.0,ses,PRESENT
+4,A-00005-F-1,baseline_visit_arm_1,1,2019-01-06 09:15,sri,0,0.0,0.0,,mri_report,EMPTY
+5,A-00006-F-1,baseline_visit_arm_1,1,2019-01-07 09:15,sri,8,,1.0,2.0,ses,PRESENT
+"""
+
+
+@pytest.fixture
+def inventory_file(tmp_path):
+    filename = tmp_path / 'inventory.csv'
+    filename.write_text(INVENTORY)
+    return str(filename)
+
+
+def test_pyarrow_reader_matches_pandas(inventory_file):
+    pytest.importorskip('pyarrow')
+    # Small blocks, so the reader can't rely on the first one for types
+    chunks = list(filter_inventory._read_inventory_pyarrow(inventory_file,
+                                                           block_size=200))
+    assert len(chunks) > 1
+    inventory = pd.concat(chunks, ignore_index=True)
+
+    columns = pd.read_csv(inventory_file, nrows=0).columns
+    expected = pd.read_csv(
+        inventory_file,
+        dtype={**{column: str for column in columns},
+               **filter_inventory.INVENTORY_DTYPES})
+
+    assert list(inventory.columns) == list(expected.columns)
+    for column, dtype in filter_inventory.INVENTORY_DTYPES.items():
+        if dtype == 'category':
+            # (concat only keeps the dtype if all chunks share categories)
+            assert all(chunk[column].dtype == 'category' for chunk in chunks)
+        else:
+            pd.testing.assert_series_equal(inventory[column],
+                                           expected[column])
+    for column in columns:
+        # Strings are passed through verbatim, with blanks as missing
+        assert _as_list(inventory[column]) == _as_list(expected[column])
+
+
+def _as_list(series):
+    series = series.astype(object)
+    return series.where(series.notna(), None).tolist()
+
+
+def test_output_keeps_columns_of_later_inputs(tmp_path):
+    # Columns that only appear in later inputs must not be dropped (as
+    # pd.concat(sort=False) of all results didn't)
+    first = tmp_path / 'first.csv'
+    first.write_text("study_id,non_nan_count,missing\n"
+                     "A-00001-F-1,5,\n")
+    second = tmp_path / 'second.csv'
+    second.write_text("study_id,non_nan_count,missing,arm\n"
+                      "A-00002-F-1,3,,1\n")
+    output = tmp_path / 'output.csv'
+
+    subprocess.check_call([sys.executable, FILTER_INVENTORY_PATH,
+                           'content_unmarked', '-o', str(output),
+                           '-i', str(first), str(second)])
+
+    assert output.read_text() == ("study_id,non_nan_count,missing,arm\n"
+                                  "A-00001-F-1,5,,\n"
+                                  "A-00002-F-1,3,,1\n")
+
+
+def test_filter_without_required_columns_is_applied():
+    def everything(inventory, ctx=None):
+        return np.ones(len(inventory), dtype=bool)
+
+    inventory = pd.DataFrame({'study_id': ['A-00001-F-1', 'A-00002-F-1']})
+    result = filter_inventory.get_filter_results(inventory, everything)
+    pd.testing.assert_frame_equal(result, inventory)
+
+
+def test_pandas_reader_writes_columns_as_read(tmp_path):
+    # Without pyarrow, columns with blanks (like arm) must still be written as
+    # they were read, not as floats
+    inventory = tmp_path / 'inventory.csv'
+    inventory.write_text("study_id,arm,non_nan_count,missing\n"
+                         "A-00001-F-1,1,5,\n"
+                         "A-00002-F-1,,3,\n")
+    output = tmp_path / 'output.csv'
+
+    # Run like `python filter_inventory.py`, i.e. with the script's directory
+    # on sys.path (numba's kernel cache may refer to the module by name)
+    subprocess.check_call([
+        sys.executable, '-c',
+        "import os, runpy, sys; sys.modules['pyarrow'] = None; "
+        "sys.argv = sys.argv[1:]; "
+        "sys.path.insert(0, os.path.dirname(sys.argv[0])); "
+        "runpy.run_path(sys.argv[0], run_name='__main__')",
+        FILTER_INVENTORY_PATH, 'content_unmarked', '-o', str(output),
+        '-i', str(inventory)])
+
+    assert output.read_text() == ("study_id,arm,non_nan_count,missing\n"
+                                  "A-00001-F-1,1,5,\n"
+                                  "A-00002-F-1,,3,\n")
+
+
+def test_map_inventory_files_keeps_input_order():
+    filenames = ['a/1.csv', 'b/2.csv', 'c/3.csv', 'd/4.csv', 'e/5.csv']
+    results = filter_inventory.map_inventory_files(os.path.basename,
+                                                   filenames, jobs=2)
+    assert list(results) == ['1.csv', '2.csv', '3.csv', '4.csv', '5.csv']
+
+
+def test_chunked_reads_match_unchunked(inventory_file, monkeypatch):
+    # In chunks of two rows, the file-wide maximum non_nan_count (8) is only
+    # in the last chunk
+    assert filter_inventory.get_max_non_nan(inventory_file, chunksize=2) == 8
+
+    monkeypatch.setattr(filter_inventory, 'pa', None)
+    inventory = pd.concat(filter_inventory.read_inventory(inventory_file))
+    expected = {name: filter_inventory.get_filter_results(inventory, function)
+                for name, function in filter_inventory.FILTERS.items()}
+
+    read_inventory = filter_inventory.read_inventory
+    get_max_non_nan = filter_inventory.get_max_non_nan
+    monkeypatch.setattr(filter_inventory, 'read_inventory',
+                        lambda filename: read_inventory(filename, chunksize=2))
+    monkeypatch.setattr(filter_inventory, 'get_max_non_nan',
+                        lambda filename: get_max_non_nan(filename, chunksize=2))
+    results = {name: [] for name in filter_inventory.FILTERS}
+    for name, result in filter_inventory.iter_filter_results(
+            inventory_file, list(filter_inventory.FILTERS.values())):
+        results[name].append(result)
+
+    assert results['less_content_than_max']
+    for name, result in results.items():
+        actual = pd.concat(result) if result else inventory.iloc[:0]
+        assert (actual['study_id'].tolist()
+                == expected[name]['study_id'].tolist()), name
+
+
+def test_numba_kernels_match_numpy(inventory_file, monkeypatch):
+    pytest.importorskip('numba')
+    inventory = next(filter_inventory.read_inventory(inventory_file))
+    compiled = {name: function(inventory)
+                for name, function in filter_inventory.FILTERS.items()}
+
+    # Swap each compiled kernel for the Python function it was compiled from
+    kernels = [name for name, kernel in vars(filter_inventory).items()
+               if hasattr(kernel, 'py_func')]
+    assert kernels
+    for name in kernels:
+        monkeypatch.setattr(filter_inventory, name,
+                            getattr(filter_inventory, name).py_func)
+
+    for name, function in filter_inventory.FILTERS.items():
+        np.testing.assert_array_equal(function(inventory), compiled[name],
+                                      err_msg=name)
+
+
+def test_multiple_filters_match_single_filter_runs(inventory_file, tmp_path):
+    filters = ['content_unmarked', 'less_content_than_max',
+               'empty_marked_present']
+    expected = {}
+    for name in filters:
+        expected[name] = subprocess.check_output(
+            [sys.executable, FILTER_INVENTORY_PATH, name,
+             '-i', inventory_file]).decode()
+
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    subprocess.check_call([sys.executable, FILTER_INVENTORY_PATH] + filters
+                          + ['-o', str(output_dir), '-i', inventory_file])
+    # (only {filter} is replaced; other braces are part of the path)
+    subprocess.check_call([sys.executable, FILTER_INVENTORY_PATH] + filters
+                          + ['-o', str(tmp_path / '{filter}_{site}.csv'),
+                             '-i', inventory_file])
+
+    for name in filters:
+        assert expected[name]
+        assert (output_dir / (name + '.csv')).read_text() == expected[name]
+        assert ((tmp_path / (name + '_{site}.csv')).read_text()
+                == expected[name])
+
+
+def test_missing_output_directory_is_reported(inventory_file, tmp_path):
+    process = subprocess.run(
+        [sys.executable, FILTER_INVENTORY_PATH, 'content_unmarked',
+         'empty_unmarked', '-o', str(tmp_path / 'missing' / '{filter}.csv'),
+         '-i', inventory_file],
+        stderr=subprocess.PIPE)
+    assert process.returncode != 0
+    assert b'does not exist' in process.stderr